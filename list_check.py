@@ -2,11 +2,26 @@
 
 import csv
 import datetime
+import functools
+import json
+import multiprocessing
 import os
+import queue
+import re
+import sys
 import time
 import requests
 import threading
 import concurrent.futures
+import itertools
+from concurrent.futures.process import BrokenProcessPool
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # optional: faster JSON parsing for large filter trees
+except ImportError:
+    orjson = None
 
 # Filenames (adjust if needed)
 LISTS_CSV = "lists_to_check.csv"
@@ -17,50 +32,139 @@ CHECKED_LISTS_CSV = "checked_lists.csv"
 # Bearer token (set via environment variable or replace directly)
 HUBSPOT_BEARER = os.environ.get("HUBSPOT_BEARER", "YOUR_BEARER_TOKEN_HERE")
 
+# Number of lists checked concurrently (set via environment variable or replace directly)
+MAX_WORKERS = int(os.environ.get("HUBSPOT_MAX_WORKERS", "5"))
+
+# HubSpot Lists API endpoints
+LISTS_URL = "https://api.hubapi.com/crm/v3/lists"
+LIST_URL_TMPL = LISTS_URL + "/%s?includeFilters=true"
+list_url = LIST_URL_TMPL.__mod__  # list_url(list_id) -> URL for a single list
+INCLUDE_FILTERS_PARAM = ("includeFilters", "true")
+
+# Number of lists fetched per API call (HubSpot's "fetch multiple lists" endpoint)
+BATCH_SIZE = 100
+
+# Worker processes used to parse API responses (set via environment variable or
+# replace directly). 0 parses inline on the request threads, which is fastest unless
+# profiling shows JSON parsing of very large filter definitions dominating.
+PARSE_PROCESSES = int(os.environ.get("HUBSPOT_PARSE_PROCESSES", "0"))
+
+# Read buffer for the input files (1 MiB: fewer read() calls on large inputs)
+READ_BUFFER_SIZE = 1 << 20
+
+# Output rows are flushed to disk in batches of this size
+FLUSH_EVERY = 64
+
+# (connect, read) timeout in seconds for each API call
+REQUEST_TIMEOUT = (5, 30)
+
+# ---------------------
+# 0) HTTP SESSION
+# Each worker thread gets its own session holding a single kept-alive
+# TCP/TLS connection to api.hubapi.com, so workers neither reconnect for
+# every list nor contend for a shared connection pool.
+# ---------------------
+# Rate-limit (429) and server errors are retried inside the connection pool
+# with exponential backoff, waiting as long as HubSpot's Retry-After asks.
+# Once retries run out the last response is returned (not raised) so its
+# status code is logged.
+RETRY = Retry(
+    total=5,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=("GET",),
+    respect_retry_after_header=True,
+    raise_on_status=False
+)
+
+thread_local = threading.local()
+
+def session():
+    """
+    Return the calling thread's requests.Session, creating it on first use.
+    """
+    s = getattr(thread_local, "session", None)
+    if s is None:
+        s = requests.Session()
+        s.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=RETRY))
+        # GET requests have no body, so no Content-Type. Accept-Encoding is left to
+        # requests, which already advertises gzip/deflate (and br when brotli is installed)
+        # and only lists encodings it can decode.
+        s.headers.update({
+            "Authorization": f"Bearer {HUBSPOT_BEARER}",
+            "Connection": "keep-alive"
+        })
+        thread_local.session = s
+    return s
+
 # ---------------------
 # 1) RATE LIMITING
-# A simple rolling-window rate limiter.
-# We'll allow 100 requests per 10-second window.
+# A token bucket: up to 50 requests can go out in a burst, after which
+# requests are paced at 10 per second (the same 100 per 10 seconds on average).
+# Worst case, a full burst plus 10 seconds of refill is 150 requests in one
+# 10-second window, still below HubSpot's usual 190.
 # ---------------------
-request_timestamps = []  # times of recent requests
-rate_lock = threading.Lock()
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at `rate` tokens per second,
+    holding at most `capacity` tokens.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token if one is available and return 0, otherwise return
+        how many seconds to wait before trying again.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+rate_limiter = TokenBucket(rate=10, capacity=50)
 
 def wait_for_rate_slot():
     """
-    Blocks until we can make another request without exceeding
-    100 requests in any rolling 10-second window.
+    Blocks until the rate limiter has a token for another request.
+    Sleeps outside the limiter's lock so other workers aren't held up.
     """
     while True:
-        with rate_lock:
-            now = time.time()
-            # Drop timestamps older than 10 seconds
-            while request_timestamps and (now - request_timestamps[0]) > 10:
-                request_timestamps.pop(0)
-
-            if len(request_timestamps) < 100:
-                # We have capacity to make a new request
-                request_timestamps.append(now)
-                return
-
-        # If we get here, the window is full. Wait a bit, then retry
-        time.sleep(0.1)
+        wait = rate_limiter.acquire()
+        if not wait:
+            return
+        time.sleep(wait)
 
 # ---------------------
 # 2) LOAD HELPER FUNCTIONS
 # ---------------------
 def load_list_ids(filename: str):
     """
-    Load Name and ListId from the CSV. 
-    The CSV header must match exactly: Name,ListId
-    """
-    lists_data = []
-    with open(filename, mode="r", encoding="utf-8-sig") as csvfile:
-        reader = csv.DictReader(csvfile, delimiter=",")
-        for row in reader:
-            lists_data.append({
-                "name": row["Name"].strip(),
-                "listId": row["ListId"].strip()
-            })
+    Load Name and ListId from the CSV as a list of (name, list_id) tuples.
+    The CSV header must include these columns exactly: Name,ListId
+    An empty file gives an empty list.
+    """
+    with open(filename, mode="r", encoding="utf-8-sig", newline="", buffering=READ_BUFFER_SIZE) as csvfile:
+        reader = csv.reader(csvfile, delimiter=",")
+        header = next(reader, None)
+        if not header:
+            return []
+        try:
+            name_idx, id_idx = header.index("Name"), header.index("ListId")
+        except ValueError:
+            raise ValueError(
+                f"{filename} must have a header row with Name,ListId columns, got: {','.join(header)}"
+            ) from None
+        lists_data = [(row[name_idx].strip(), row[id_idx].strip()) for row in reader if row]
     return lists_data
 
 def load_properties(filename: str):
@@ -70,114 +174,266 @@ def load_properties(filename: str):
     """
     prop_list = []
     prop_set = set()
-    with open(filename, "r", encoding="utf-8-sig") as txtfile:
+    with open(filename, "r", encoding="utf-8-sig", buffering=READ_BUFFER_SIZE) as txtfile:
         for line in txtfile:
-            p = line.strip()
+            # Interned so lookups against property names from the API compare by identity first
+            p = sys.intern(line.strip())
             if p:
                 prop_list.append(p)
                 prop_set.add(p)
     return prop_list, prop_set
 
+def parse_json(content: bytes):
+    """
+    Decode an API response body, using orjson when it's installed.
+    Raises ValueError if the body isn't valid JSON.
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
 # ---------------------
 # 3) LOGGING ONLY ERRORS
 # ---------------------
-log_lock = threading.Lock()
+# Rows queued here are appended to LOG_CSV by a writer thread started in main()
+log_queue = queue.Queue(maxsize=1024)
 
 def log_error(list_name: str, list_id: str, status_code: int, error_message: str):
     """
-    Append a single row to the log file, but only for errors.
+    Queue a single row for the log file, but only for errors.
     Columns: [DateTime, List_Name, List_ID, StatusCode, ErrorMessage]
+    The raw time.time() is queued; the writer thread formats it.
+    """
+    log_queue.put((time.time(), list_name, list_id, status_code, error_message))
+
+def write_log_row(log_writer, row):
+    """
+    Write one queued error row, formatting its timestamp on the way out.
     """
-    now = datetime.datetime.now().isoformat()
-    with log_lock:
-        with open(LOG_CSV, mode="a", encoding="utf-8", newline="") as csvfile:
-            writer = csv.writer(csvfile, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            writer.writerow([now, list_name, list_id, status_code, error_message])
+    log_writer.writerow((datetime.datetime.fromtimestamp(row[0]).isoformat(),) + row[1:])
+
+def writer_loop(q, out_f, write_row, outcome):
+    """
+    Runs in its own thread: pass each row taken from q to write_row until
+    None is received. Flushes out_f every FLUSH_EVERY rows and once at the end,
+    so workers never block on disk I/O.
+    If writing fails (e.g. disk full), the exception is stored on the outcome
+    Future for main() to re-raise, and the rest of the queue is drained and
+    discarded so workers can't block forever on a full queue.
+    """
+    try:
+        pending = 0
+        for row in iter(q.get, None):
+            write_row(row)
+            pending += 1
+            if pending >= FLUSH_EVERY:
+                out_f.flush()
+                pending = 0
+        out_f.flush()
+    except BaseException as e:
+        outcome.set_exception(e)
+        for _ in iter(q.get, None):
+            pass
+    else:
+        outcome.set_result(None)
+
+_needs_quote = re.compile(r'[,"\r\n]').search
+
+def csv_field(value: str):
+    """
+    Quote a single CSV cell the same way csv.QUOTE_MINIMAL would, but only
+    pay for it when the cell contains a comma, quote or line break.
+    """
+    if _needs_quote(value):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+def make_result_formatter(property_list):
+    """
+    Return format_result_row(list_name, list_id, found_props), which builds one
+    line of checked_lists.csv. Workers only queue the (small) set of properties
+    they found, or None on error; the column layout is worked out once here and
+    the full row of "TRUE" / "" / "ERROR" cells is only expanded in the writer.
+    Those cells never need quoting, so only the name and id go through csv_field.
+    """
+    columns = {}  # property -> its column index(es), in case a property is listed twice
+    for i, p in enumerate(property_list):
+        columns.setdefault(p, []).append(i)
+    blank_cells = [""] * len(property_list)
+    error_cells = ["ERROR"] * len(property_list)
+
+    def format_result_row(list_name: str, list_id: str, found_props):
+        if found_props is None:
+            cells = error_cells
+        else:
+            cells = blank_cells.copy()
+            for p in found_props:
+                for i in columns[p]:
+                    cells[i] = "TRUE"
+        return ",".join([csv_field(list_name), csv_field(list_id)] + cells) + "\r\n"
+
+    return format_result_row
 
 # ---------------------
 # 4) EXTRACT PROPERTIES FROM THE JSON
 # ---------------------
-def traverse_filter_branches(branch, found_props, properties_to_check):
+def traverse_filter_branches(top_branch, found_props, properties_to_check, target_count):
     """
-    Recursively traverse filterBranches to find filters with filterType="PROPERTY".
+    Walk filterBranches depth-first (using an explicit stack rather than
+    recursion) to find filters with filterType="PROPERTY".
     If 'property' is in properties_to_check, add it to found_props.
+    Stops early once all target_count properties have been found.
     """
-    if not branch:
-        return
+    stack = [top_branch] if top_branch else []
+    while stack:
+        branch = stack.pop()
+        if not branch:
+            # HubSpot can return null/empty sub-branches; nothing to scan
+            continue
+        for f in branch.get("filters", ()):
+            if f.get("filterType") == "PROPERTY":
+                prop_name = f.get("property", "")
+                if prop_name in properties_to_check:
+                    found_props.add(prop_name)
+                    if len(found_props) == target_count:
+                        # Nothing left to find in the rest of the tree
+                        return
 
-    filters = branch.get("filters", [])
-    for f in filters:
-        if f.get("filterType") == "PROPERTY":
-            prop_name = f.get("property", "")
-            if prop_name in properties_to_check:
-                found_props.add(prop_name)
+        # Queue up sub-branches
+        stack.extend(branch.get("filterBranches", ()))
 
-    # Recurse into sub-branches
-    for sub in branch.get("filterBranches", []):
-        traverse_filter_branches(sub, found_props, properties_to_check)
-
-def check_list_properties(response_json: dict, properties_to_check: set):
+def check_list_properties(list_obj: dict, properties_to_check: set):
     """
     Return a set of property names found in the list's filters.
-    We look under response_json["list"]["filterBranch"].
+    We look under list_obj["filterBranch"].
     """
     found_props = set()
-    list_obj = response_json.get("list", {})
+    target_count = len(properties_to_check)
     top_branch = list_obj.get("filterBranch", {})
-    traverse_filter_branches(top_branch, found_props, properties_to_check)
+    traverse_filter_branches(top_branch, found_props, properties_to_check, target_count)
     return found_props
 
+def extract_found_props(content: bytes, properties_to_check):
+    """
+    Parse a Lists API response body and return (list_id, found_props) pairs,
+    one per list in it. Handles both the batch shape {"lists": [...]} and the
+    single-list shape {"list": {...}}.
+    """
+    data = parse_json(content)
+    if "lists" in data:
+        list_objs = data["lists"]
+    else:
+        list_objs = [data.get("list", {})]
+    return [(str(l.get("listId")), check_list_properties(l, properties_to_check)) for l in list_objs]
+
+# Process pool for parsing responses, created in main() when PARSE_PROCESSES > 0
+parse_pool = None
+
+# Set only inside parse worker processes, by init_parse_worker
+worker_property_set = None
+
+def init_parse_worker(property_set: frozenset):
+    """
+    Process pool initializer: keep one copy of the properties to check in each
+    worker process, so it isn't pickled again with every response.
+    """
+    global worker_property_set
+    worker_property_set = property_set
+
+def extract_in_worker(content: bytes):
+    """
+    Runs in a parse worker process: extract_found_props using that process's property set.
+    """
+    return extract_found_props(content, worker_property_set)
+
+def run_extract(content: bytes, property_set):
+    """
+    Run extract_found_props inline, or in the parse process pool if one is enabled
+    (see PARSE_PROCESSES), which keeps CPU-heavy parsing off the network threads.
+    Raises BrokenProcessPool if a parse worker has died (e.g. out of memory);
+    the pool can't be reused after that.
+    """
+    if parse_pool is None:
+        return extract_found_props(content, property_set)
+    return parse_pool.submit(extract_in_worker, content).result()
+
 # ---------------------
-# 5) THE WORKER FUNCTION FOR EACH LIST
+# 5) THE WORKER FUNCTIONS
 # ---------------------
-def check_single_list(item, property_list, property_set):
+def check_list_batch(items, property_set, row_queue):
+    """
+    1) Wait for a token from the rate limiter (10 requests/s, bursts of up to 50).
+    2) Fetch every list in items with a single GET call.
+    3) Put (list_name, list_id, found_props) on row_queue for each list returned.
+    4) Any list missing from the response (or the whole batch, if the call
+       fails) is retried on its own with check_single_list, so errors are
+       still logged against the list that caused them.
+    """
+    # 1) Wait for rate limit
+    wait_for_rate_slot()
+
+    # 2) Make the GET request
+    params = [("listIds", list_id) for _, list_id in items]
+    params.append(INCLUDE_FILTERS_PARAM)
+    try:
+        resp = session().get(LISTS_URL, params=params, timeout=REQUEST_TIMEOUT)
+        if resp.ok:
+            found_by_id = dict(run_extract(resp.content, property_set))
+        else:
+            found_by_id = {}
+    except (requests.RequestException, ValueError, BrokenProcessPool):
+        found_by_id = {}
+
+    # 3) Hand each row to the writer thread, 4) falling back per list
+    for item in items:
+        list_name, list_id = item
+        found_props = found_by_id.get(list_id)
+        if found_props is None:
+            check_single_list(item, property_set, row_queue)
+            continue
+        row_queue.put((list_name, list_id, found_props))
+
+def check_single_list(item, property_set, row_queue):
     """
-    1) Wait for a rate slot (so we don't exceed 100 requests/10s).
+    1) Wait for a token from the rate limiter (10 requests/s, bursts of up to 50).
     2) Make the GET call.
-    3) Return (list_name, list_id, results).
-       Where results is a list of "TRUE" or "" for each property in property_list.
-    4) If there's an error, log it, and return "ERROR" for all properties.
+    3) Put (list_name, list_id, found_props) on row_queue for the writer thread.
+       Where found_props is the set of properties from property_set in the list's filters.
+    4) If there's an error, log it, and use None so the row shows "ERROR" for all properties.
     """
-    list_name = item["name"]
-    list_id = item["listId"]
+    list_name, list_id = item
 
     # 1) Wait for rate limit
     wait_for_rate_slot()
 
     # 2) Make the GET request
-    url = f"https://api.hubapi.com/crm/v3/lists/{list_id}?includeFilters=true"
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_BEARER}",
-        "Content-Type": "application/json"
-    }
     try:
-        resp = requests.get(url, headers=headers)
+        resp = session().get(list_url(list_id), timeout=REQUEST_TIMEOUT)
         if resp.ok:
-            data = resp.json()
-            found_props = check_list_properties(data, property_set)
-            # Build a list of "TRUE" or ""
-            row_values = [("TRUE" if p in found_props else "") for p in property_list]
-            return (list_name, list_id, row_values, None)  # no error
+            _, found_props = run_extract(resp.content, property_set)[0]
         else:
             # Non-OK -> log the error
             error_msg = f"API error: {resp.text}"
             log_error(list_name, list_id, resp.status_code, error_msg)
 
-            # Return "ERROR" for each property
-            row_values = ["ERROR"] * len(property_list)
-            return (list_name, list_id, row_values, error_msg)
+            # None -> "ERROR" for each property
+            found_props = None
 
-    except requests.RequestException as e:
-        # Network or connection error -> log it
+    except (requests.RequestException, ValueError, BrokenProcessPool) as e:
+        # Network, connection, malformed-response or dead parse worker error -> log it
         error_msg = str(e)
         log_error(list_name, list_id, 0, error_msg)
-        row_values = ["ERROR"] * len(property_list)
-        return (list_name, list_id, row_values, error_msg)
+        found_props = None
+
+    # 3) Hand the result to the writer thread
+    row_queue.put((list_name, list_id, found_props))
 
 # ---------------------
 # 6) MAIN ROUTINE - MULTITHREADED
 # ---------------------
 def main():
+    global parse_pool
+
     # Load data
     lists_data = load_list_ids(LISTS_CSV)
     property_list, property_set = load_properties(PROPERTIES_TXT)
@@ -189,31 +445,70 @@ def main():
             writer.writerow(["DateTime", "List_Name", "List_ID", "StatusCode", "ErrorMessage"])
 
     # Prepare output file: write the header row once
-    # We'll keep it open the entire run, but we must coordinate writes from multiple threads
-    with open(CHECKED_LISTS_CSV, "w", encoding="utf-8", newline="") as out_f:
+    # We'll keep both files open the entire run; a single writer thread per file
+    # does all the writing, fed by a queue that the workers push rows onto
+    with open(CHECKED_LISTS_CSV, "w", encoding="utf-8", newline="") as out_f, \
+         open(LOG_CSV, "a", encoding="utf-8", newline="") as log_f:
         writer = csv.writer(out_f, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
         header = ["Name", "ListId"] + property_list
         writer.writerow(header)
 
-        write_lock = threading.Lock()  # to synchronize writing rows
-
-        # We'll use a thread pool so we can do multiple requests concurrently
-        max_workers = 5  # or some number that is reasonable for your environment
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = []
-            for item in lists_data:
-                # schedule each list check
-                fut = executor.submit(check_single_list, item, property_list, property_set)
-                futures.append(fut)
-
-            # As each future completes, immediately write its row to CSV
-            for fut in concurrent.futures.as_completed(futures):
-                list_name, list_id, row_values, err_msg = fut.result()
-                # row_values is the list of "TRUE"/"" or "ERROR"
-                with write_lock:
-                    writer.writerow([list_name, list_id] + row_values)
-                    # Flush so each row is on disk immediately
-                    out_f.flush()
+        log_writer = csv.writer(log_f, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+        format_result_row = make_result_formatter(property_list)
+        row_queue = queue.Queue(maxsize=1024)
+        # Each writer reports success or its exception here
+        writer_outcomes = [concurrent.futures.Future(), concurrent.futures.Future()]
+        writer_threads = [
+            threading.Thread(
+                target=writer_loop,
+                args=(row_queue, out_f, lambda row: out_f.write(format_result_row(*row)), writer_outcomes[0]),
+                daemon=True
+            ),
+            threading.Thread(
+                target=writer_loop,
+                args=(log_queue, log_f, functools.partial(write_log_row, log_writer), writer_outcomes[1]),
+                daemon=True
+            ),
+        ]
+        for t in writer_threads:
+            t.start()
+
+        try:
+            if PARSE_PROCESSES > 0:
+                # Workers are started lazily from a request thread while other threads
+                # are running, so spawn them fresh rather than fork this process.
+                parse_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=PARSE_PROCESSES,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_parse_worker,
+                    initargs=(frozenset(property_set),)
+                )
+
+            # We'll use a thread pool so we can do multiple requests concurrently
+            with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                futures = []
+                items = iter(lists_data)
+                for batch in iter(lambda: list(itertools.islice(items, BATCH_SIZE)), []):
+                    # schedule one check per batch of lists
+                    fut = executor.submit(check_list_batch, batch, property_set, row_queue)
+                    futures.append(fut)
+
+                # Surface any unexpected exception raised inside a worker
+                for fut in concurrent.futures.as_completed(futures):
+                    fut.result()
+        finally:
+            # Tell the writers we're done and wait for them to drain their queues
+            row_queue.put(None)
+            log_queue.put(None)
+            for t in writer_threads:
+                t.join()
+            if parse_pool is not None:
+                parse_pool.shutdown()
+                parse_pool = None
+            # Re-raise a write failure (e.g. disk full) rather than leave a truncated file
+            for outcome in writer_outcomes:
+                outcome.result()
 
 if __name__ == "__main__":
     main()